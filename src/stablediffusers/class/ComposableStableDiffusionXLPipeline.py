@@ -1,15 +1,42 @@
 from stablediffusers.util import module
+from stablediffusers import LazyComponent, EmbeddingStore
 
-cv2 = module("cv2")
+find_spec = module("importlib.util", "find_spec")
 Image, ImageDraw, ImageFont = module("PIL", ["Image", "ImageDraw", "ImageFont"])
-join = module("os.path", "join")
+join, abspath, basename, dirname, expanduser, isdir, isfile, splitext = module("os.path", [
+  "join", "abspath", "basename", "dirname", "expanduser", "isdir", "isfile", "splitext"
+])
+listdir, makedirs, stat, walk = module("os", ["listdir", "makedirs", "stat", "walk"])
+json = module("json")
+connect = module("sqlite3", "connect")
+sha256 = module("hashlib", "sha256")
+chain = module("itertools", "chain")
+OrderedDict = module("collections", "OrderedDict")
+pack = module("struct", "pack")
+sub = module("re", "sub")
+WeakKeyDictionary = module("weakref", "WeakKeyDictionary")
+compressobj, crc32 = module("zlib", ["compressobj", "crc32"])
+numpy = module("numpy")
+torch = module("torch")
+futures = module("concurrent.futures")
+BytesIO = module("io", "BytesIO")
+perf_counter = module("time", "perf_counter")
+RLock, Thread, Event, local = module("threading", ["RLock", "Thread", "Event", "local"])
+copy, deepcopy = module("copy", ["copy", "deepcopy"])
+remove, replace = module("os", ["remove", "replace"])
+contextmanager = module("contextlib", "contextmanager")
+sysconf = module("os", "sysconf")
 
 StableDiffusionXLPipeline = module("diffusers", "StableDiffusionXLPipeline")
+CLIPTokenizer = module("transformers", "CLIPTokenizer")
+FrozenDict = module("diffusers.configuration_utils", "FrozenDict")
 
 get_weighted_text_embeddings_sdxl = module("sd_embed.embedding_funcs", "get_weighted_text_embeddings_sdxl")
 
 collect = module("gc", "collect")
-empty_cache, ipc_collect, set_device = module("torch.cuda", ["empty_cache", "ipc_collect", "set_device"])
+empty_cache, ipc_collect, set_device, reset_peak_memory_stats, max_memory_allocated = module("torch.cuda", [
+  "empty_cache", "ipc_collect", "set_device", "reset_peak_memory_stats", "max_memory_allocated"
+])
 init_empty_weights = module("accelerate", "init_empty_weights")
 load_model_dict_into_meta = module("diffusers.models.model_loading_utils", "load_model_dict_into_meta")
 
@@ -46,6 +73,57 @@ default = {
   }
 }
 
+default.update({
+  "catalog" : {
+    "database" : join(expanduser("~"), ".cache", "stablediffusers", "catalog.db"),
+    "hash" : "header"
+  }
+})
+
+default.update({
+  "embeddings" : {
+    "batch_size" : 64,
+    "workers" : 2
+  }
+})
+
+default.update({
+  "output" : {
+    "format" : "png",
+    "workers" : 4,
+    "queue_size" : 8,
+    "options" : {
+      "png" : {
+        "compress_level" : 6
+      },
+      "webp" : {
+        "quality" : 90,
+        "method" : 4
+      },
+      "jpeg" : {
+        "quality" : 95
+      }
+    }
+  }
+})
+
+default.update({
+  "profile" : "default",
+  "profiles" : {
+    "default" : {
+      "sequential" : False,
+      "vae_tiling" : False,
+      "attention_slice" : None
+    },
+    "low_memory" : {
+      "sequential" : True,
+      # size of the tiles in pixels, or True for the size the VAE was trained on (1024 for SDXL)
+      "vae_tiling" : 512,
+      "attention_slice" : "auto"
+    }
+  }
+})
+
 default.update({
   "inference" : {
     "torch_dtype" : module("torch").float16,
@@ -67,6 +145,32 @@ class ComposableStableDiffusionXLPipeline:
   path = {}
   current = None
 
+  fonts = {}
+  # wrapped prompts, least recently used first
+  layouts = OrderedDict()
+  layouts_size = 256
+
+  __lazy_pipeline_classes = {}
+  # where loaded components come from, and hashes of their weights
+  __sources = WeakKeyDictionary()
+  __weights_hashes = WeakKeyDictionary()
+  __file_hashes = {}
+
+  __config_keys_to_skip = {"_diffusers_version", "_name_or_path", "_use_default_values"}
+  # Bump the version whenever the schema changes, older catalogs are then rebuilt on the next scan
+  __catalog_version = 1
+  __catalog_schema = """
+    CREATE TABLE IF NOT EXISTS files (
+      path TEXT PRIMARY KEY, model TEXT, component TEXT, variant TEXT, kind TEXT,
+      mtime REAL, size INTEGER, layout_hash TEXT, hash TEXT, data TEXT
+    );
+    CREATE TABLE IF NOT EXISTS tensors (
+      path TEXT, key TEXT, dtype TEXT, shape TEXT, start INTEGER, end INTEGER,
+      PRIMARY KEY (path, key)
+    );
+    CREATE INDEX IF NOT EXISTS files_by_model ON files (model, component, kind);
+  """
+
   @classmethod
   def __get_model_from_store(cls, *args, **kwargs):
     key, *_ = list(args) + [None]
@@ -120,6 +224,7 @@ class ComposableStableDiffusionXLPipeline:
     path, *_ = list(args) + [None]
     path = path if path else default["model"]
     skip_load_from_memory = kwargs.pop("skip_load_from_memory", False)
+    lazy = kwargs.pop("lazy", False)
     name = kwargs.pop("name", path)
     if not skip_load_from_memory :
       by_path = cls.__get_model_from_store(path)
@@ -132,15 +237,21 @@ class ComposableStableDiffusionXLPipeline:
         logger.info(f"Loading model {name} from memory")
         return cls
     logger.info(f"Loading model {name} from {path}")
-    try :
-      inference = default["inference"].copy()
-      return default["merging"][name]["model"].from_pretrained(path, **inference, **{
-        "subfolder" : name
-      })
-    except :
-      logger.info("Logging default variant instead")
-      inference.pop("variant")
-      pipeline = StableDiffusionXLPipeline.from_pretrained(path, **kwargs, **inference).to(dtype=default["inference"]["torch_dtype"])
+    if lazy :
+      pipeline = cls.__load_lazy_pipeline(path, **kwargs)
+    else :
+      try :
+        inference = default["inference"].copy()
+        return default["merging"][name]["model"].from_pretrained(path, **inference, **{
+          "subfolder" : name
+        })
+      except :
+        logger.info("Logging default variant instead")
+        inference.pop("variant")
+        pipeline = StableDiffusionXLPipeline.from_pretrained(path, **kwargs, **inference).to(dtype=default["inference"]["torch_dtype"])
+        for component in default["merging"]:
+          if component not in kwargs :
+            cls.__record_source(getattr(pipeline, component), path, component, "")
     cls.name[name] = [None, [name], pipeline]
     cls.current = cls.name[name]
     if "unet" in kwargs or "text_encoder" in kwargs or "text_encoder_2" in kwargs or "vae" in kwargs :
@@ -192,18 +303,216 @@ class ComposableStableDiffusionXLPipeline:
   @classmethod
   def prompt_fix(cls, *args, **kwargs):
     prompt, *_ = list(args) + [kwargs.pop("prompt", None)]
-    return cls.combine_tuples_into_dict((
-      "prompt_embeds",
-      "prompt_neg_embeds",
-      "pooled_prompt_embeds",
-      "negative_pooled_prompt_embeds"
-    ), get_weighted_text_embeddings_sdxl(cls.current[2], prompt = ', '.join(filter(None, (
+    pipeline = kwargs.pop("pipeline", None)
+    embeddings = kwargs.pop("embeddings", None)
+    pipeline = cls.current[2] if pipeline is None else pipeline
+    prompt = ', '.join(filter(None, (
       prompt,
       kwargs.pop("prompt_2", None)
-    ))), neg_prompt = ', '.join(filter(None, (
+    )))
+    negative_prompt = ', '.join(filter(None, (
       kwargs.pop("negative_prompt", None),
       kwargs.pop("negative_prompt_2", None)
-    )))))
+    )))
+    if embeddings is not None :
+      encoder = cls.__encoder_identity(pipeline)
+      stored = embeddings.get(prompt, negative_prompt, encoder = encoder) if encoder is not None else None
+      if stored is not None :
+        return stored
+    return cls.combine_tuples_into_dict((
+      "prompt_embeds",
+      "negative_prompt_embeds",
+      "pooled_prompt_embeds",
+      "negative_pooled_prompt_embeds"
+    ), get_weighted_text_embeddings_sdxl(pipeline, prompt = prompt, neg_prompt = negative_prompt))
+
+  @classmethod
+  def __encoder_identity(cls, pipeline):
+    """
+    Hash of the weights and dtype of both text encoders, or None if they cannot be identified
+
+    Text encoders loaded from a local checkpoint and left unchanged are identified by the contents
+    of their weights files, so lazy text encoders are not loaded. Any other text encoder (e.g. a
+    merged one) is identified by a hash of its parameters.
+    """
+    identity = []
+    for name in ("text_encoder", "text_encoder_2"):
+      component = getattr(pipeline, name, None)
+      if component is None :
+        identity.append(None)
+        continue
+      digest = cls.__weights_hash(component)
+      if digest is None :
+        return None
+      identity.append([digest, str(component.dtype)])
+    return sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+  @classmethod
+  def __record_source(cls, component, path, name, variant):
+    cls.__sources[component] = (path, name, variant, cls.__parameter_versions(component))
+    return component
+
+  @classmethod
+  def __parameter_versions(cls, component):
+    # Every in-place update bumps the version of a tensor, and casting or replacing it changes its dtype or id
+    return tuple((id(tensor), tensor._version, tensor.dtype) for tensor in chain(component.parameters(), component.buffers()))
+
+  @classmethod
+  def __weights_hash(cls, component):
+    if isinstance(component, LazyComponent) :
+      if not component.is_loaded :
+        if component.source is None :
+          return None
+        path, name = component.source
+        return cls.__files_hash(path, name, cls.__preferred_variant(path, name))
+      component = component.load()
+    versions = cls.__parameter_versions(component)
+    source = cls.__sources.get(component)
+    if source is not None and source[3] == versions :
+      digest = cls.__files_hash(*source[:3])
+      if digest is not None :
+        return digest
+    cached = cls.__weights_hashes.get(component)
+    if cached is not None and cached[0] == versions :
+      return cached[1]
+    hasher = sha256()
+    for key, tensor in sorted(chain(component.named_parameters(remove_duplicate = False), component.named_buffers(remove_duplicate = False)), key = lambda item: item[0]):
+      hasher.update(json.dumps([key, str(tensor.dtype), list(tensor.shape)]).encode("utf-8"))
+      hasher.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+    cls.__weights_hashes[component] = (versions, hasher.hexdigest())
+    return cls.__weights_hashes[component][1]
+
+  @classmethod
+  def __preferred_variant(cls, path, name):
+    """
+    The variant `__get_component` loads for component `name` of the local checkpoint at `path`
+    """
+    preferred = default["inference"]["variant"]
+    directory = join(path, name)
+    # The catalog mirrors the directory of a local checkpoint, so there is no need to open it
+    if isdir(directory) :
+      variants = {cls.__file_variant(file_name) for file_name in listdir(directory) if file_name.endswith(".safetensors")}
+    else :
+      variants = cls.catalog_variants(path, name = name)
+    return preferred if variants and preferred in variants else ""
+
+  @classmethod
+  def __files_hash(cls, path, name, variant):
+    """
+    Hash of the contents of the weights files of component `name` of the local checkpoint at `path`
+
+    Content hashes recorded in the catalog are reused, missing ones are computed and recorded.
+    Returns None when the checkpoint is not a local directory.
+    """
+    directory = join(path, name)
+    if not isdir(directory) :
+      return None
+    file_paths = sorted(join(abspath(directory), file_name) for file_name in listdir(directory)
+      if file_name.endswith(".safetensors") and cls.__file_variant(file_name) == variant)
+    if not file_paths :
+      return None
+    keys = []
+    for file_path in file_paths:
+      info = stat(file_path)
+      keys.append((file_path, info.st_mtime, info.st_size))
+    missing = [key for key in keys if key not in cls.__file_hashes]
+    # The catalog is only opened for files that were not hashed yet by this process
+    connection = cls.__catalog() if missing else None
+    try :
+      for key in missing:
+        row = connection.execute(
+          "SELECT hash FROM files WHERE path = ? AND mtime = ? AND size = ?", key
+        ).fetchone() if connection is not None else None
+        if row is not None and row[0] is not None :
+          cls.__file_hashes[key] = row[0]
+          continue
+        hasher = sha256()
+        with open(key[0], "rb") as file :
+          for chunk in iter(lambda: file.read(1 << 24), b""):
+            hasher.update(chunk)
+        cls.__file_hashes[key] = hasher.hexdigest()
+        if row is not None :
+          with connection :
+            connection.execute("UPDATE files SET hash = ? WHERE path = ?", (cls.__file_hashes[key], key[0]))
+    finally :
+      if connection is not None :
+        connection.close()
+    hashes = [[basename(key[0]), cls.__file_hashes[key]] for key in keys]
+    return sha256(json.dumps(hashes).encode("utf-8")).hexdigest()
+
+  @classmethod
+  def open_embeddings(cls, path):
+    return EmbeddingStore(path)
+
+  @classmethod
+  def precompute_embeddings(cls, prompts, output, **kwargs):
+    """
+    Encode `prompts` with the text encoders of the current model into an `EmbeddingStore` at `output`
+
+    `prompts` is a text file with one prompt per line, or an iterable of prompts or of
+    `(prompt, negative_prompt)` pairs. Prompts are encoded like `prompt_fix` does, in batches
+    of `batch_size` spread over `workers` threads, and appended to the store. Prompts that are
+    already stored are skipped. An existing store made with other text encoders is refused.
+    """
+    negative_prompt = kwargs.pop("negative_prompt", "")
+    batch_size = kwargs.pop("batch_size", default["embeddings"]["batch_size"])
+    workers = kwargs.pop("workers", default["embeddings"]["workers"])
+    pipeline = cls.current[2]
+    encoder = cls.__encoder_identity(pipeline)
+    if encoder is None :
+      raise ValueError("The text encoders of the current model cannot be identified, load it from a local checkpoint")
+    if isinstance(prompts, str) :
+      with open(prompts, encoding = "utf-8") as file :
+        prompts = [line.strip() for line in file if line.strip()]
+    makedirs(output, exist_ok = True)
+    index_path = join(output, "index.json")
+    index = {"encoder" : encoder, "entries" : {}}
+    if isfile(index_path) :
+      with open(index_path, encoding = "utf-8") as file :
+        index = json.load(file)
+      if index["encoder"] != encoder :
+        raise ValueError(f"Embeddings in {output} were made with different text encoders")
+    pending = {}
+    for prompt in prompts:
+      prompt, negative = (prompt, negative_prompt) if isinstance(prompt, str) else prompt
+      key = EmbeddingStore.key(prompt, negative)
+      if key not in index["entries"] :
+        pending.setdefault(key, (prompt, negative))
+    pending = list(pending.items())
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    logger.info(f"Encoding {len(pending)} prompts in {len(batches)} batches")
+    state = local()
+    def encode(batch):
+      if not hasattr(state, "pipeline") :
+        # Tokenizers are not safe to share between threads, text encoders are
+        state.pipeline = copy(pipeline)
+        state.pipeline.__dict__["tokenizer"] = deepcopy(pipeline.tokenizer)
+        state.pipeline.__dict__["tokenizer_2"] = deepcopy(pipeline.tokenizer_2)
+      with torch.no_grad():
+        return [(key, prompt, negative, cls.prompt_fix(prompt, negative_prompt = negative, pipeline = state.pipeline)) for key, (prompt, negative) in batch]
+    with open(join(output, "embeddings.bin"), "ab") as file, futures.ThreadPoolExecutor(max_workers = workers) as pool :
+      offset = file.tell()
+      for results in logging.tqdm(pool.map(encode, batches), total = len(batches), desc = "Encoding prompts"):
+        for key, prompt, negative, embeddings in results:
+          tensors = {}
+          for name, tensor in embeddings.items():
+            # Align every tensor so it can be viewed in place with its own dtype
+            padding = -offset % 64
+            file.write(bytes(padding))
+            offset += padding
+            data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+            file.write(data)
+            tensors[name] = [offset, offset + len(data), str(tensor.dtype).split(".")[-1], list(tensor.shape)]
+            offset += len(data)
+          index["entries"][key] = {
+            "prompt" : prompt,
+            "negative_prompt" : negative,
+            "tensors" : tensors
+          }
+    with open(index_path + ".tmp", "w", encoding = "utf-8") as file :
+      json.dump(index, file)
+    replace(index_path + ".tmp", index_path)
+    return EmbeddingStore(output)
 
   @classmethod
   def compose(cls, *args, **kwargs):
@@ -222,45 +531,595 @@ class ComposableStableDiffusionXLPipeline:
       kwargs.setdefault("text_encoder", model.text_encoder)
       kwargs.setdefault("text_encoder_2", model.text_encoder_2)
       kwargs.setdefault("vae", model.vae)
+      # Placeholders of a lazy model can only be shared with another lazy model
+      if any(isinstance(kwargs[component], LazyComponent) for component in default["merging"]) :
+        kwargs["lazy"] = True
+      if kwargs.get("lazy", False) :
+        kwargs.setdefault("tokenizer", model.tokenizer)
+        kwargs.setdefault("tokenizer_2", model.tokenizer_2)
+        kwargs.setdefault("scheduler", model.scheduler.from_config(model.scheduler.config))
     return cls.load_model(path, skip_load_from_memory = True, **kwargs)
 
+  @classmethod
+  def __load_component_config(cls, path, **kwargs):
+    name = kwargs.setdefault("name", "unet")
+    model = default["merging"][name]["model"]
+    config = cls.catalog_config(path, name = name)
+    if "text_encoder" in name :
+      config = model.config_class.from_pretrained(path, subfolder = name) if config is None else model.config_class.from_dict(config)
+      # Match the config of a loaded component, which records where it was loaded from
+      config._name_or_path = path
+      return config
+    return FrozenDict(config if config is not None else model.load_config(path, subfolder = name))
+
+  @classmethod
+  def __lazy_component(cls, path, **kwargs):
+    name = kwargs.setdefault("name", "unet")
+    return LazyComponent(
+      lambda : cls.__get_component(path, name = name, skip_load_from_memory = True).to(cls.device),
+      config = lambda : cls.__load_component_config(path, name = name),
+      torch_dtype = default["inference"]["torch_dtype"],
+      source = (path, name)
+    )
+
+  @classmethod
+  def __load_lazy_pipeline(cls, path, **kwargs):
+    """
+    Build a pipeline whose components are only loaded (memory-mapped from safetensors) on first use
+
+    Components passed as modules are used as is, components passed as a path are loaded lazily
+    from that path, and missing components are loaded lazily from `path`.
+    """
+    for name in default["merging"]:
+      component = kwargs.get(name, path)
+      if isinstance(component, str) :
+        kwargs[name] = cls.__lazy_component(component, name = name)
+    for name in ("tokenizer", "tokenizer_2"):
+      if name not in kwargs :
+        kwargs[name] = CLIPTokenizer.from_pretrained(path, subfolder = name)
+    if "scheduler" not in kwargs :
+      _, scheduler = StableDiffusionXLPipeline.load_config(path)["scheduler"]
+      kwargs["scheduler"] = module("diffusers", scheduler).from_pretrained(path, subfolder = "scheduler")
+    pipeline = StableDiffusionXLPipeline(**kwargs)
+    # Placeholders are not `torch.nn.Module`s, so diffusers cannot infer the execution device from them
+    base = type(pipeline)
+    if base not in cls.__lazy_pipeline_classes :
+      cls.__lazy_pipeline_classes[base] = type(f"Lazy{base.__name__}", (base,), {
+        "device" : property(lambda self : cls.device),
+        "_execution_device" : property(lambda self : cls.device)
+      })
+    pipeline.__class__ = cls.__lazy_pipeline_classes[base]
+    return pipeline
+
+  @classmethod
+  def residency(cls, *args, **kwargs):
+    """
+    Report for every component of a stored model whether it is lazy, loaded and for how long it has been idle
+    """
+    pipeline = cls.from_loaded(*args, **kwargs)
+    residency = {}
+    for name in default["merging"]:
+      component = getattr(pipeline, name, None)
+      lazy = isinstance(component, LazyComponent)
+      residency[name] = {
+        "lazy" : lazy,
+        "loaded" : component.is_loaded if lazy else component is not None,
+        "idle" : perf_counter() - component.last_used if lazy and component.is_loaded else None
+      }
+    return residency
+
+  @classmethod
+  def release(cls, *args, **kwargs):
+    """
+    Release the loaded lazy `components` of a stored model (all of them by default)
+    With `idle`, only components unused for at least that many seconds are released
+    """
+    components = kwargs.pop("components", None)
+    idle = kwargs.pop("idle", None)
+    pipeline = cls.from_loaded(*args, **kwargs)
+    released = []
+    for name in components or default["merging"]:
+      component = getattr(pipeline, name, None)
+      if not isinstance(component, LazyComponent) or not component.is_loaded :
+        continue
+      if idle is not None and perf_counter() - component.last_used < idle :
+        continue
+      component.release()
+      released.append(name)
+    if released :
+      cls.flush()
+    return released
+
+  @classmethod
+  def get_font(cls, size = 30):
+    if size not in cls.fonts :
+      # requires a newer version of pillow
+      # use the truetype font shipped with cv2, located without importing cv2 itself
+      font_path = join(find_spec("cv2").submodule_search_locations[0], 'qt', 'fonts', 'DejaVuSans.ttf')
+      cls.fonts[size] = ImageFont.truetype(font_path, size)
+    return cls.fonts[size]
+
   @classmethod
   def wrap_text(cls, text, max_width, font):
+    key = (text, max_width, font)
+    if key in cls.layouts :
+      cls.layouts.move_to_end(key)
+      return cls.layouts[key]
     lines = []
-    current_line = ""
-    words = text.split(" ")
-    for word in words:
-      test_line = current_line + word + " "
-      line_width = font.getlength(test_line)
-      if line_width <= max_width:
-        current_line = test_line
-      else:
-        lines.append(current_line[:-1])
-        current_line = word + " "
-    lines.append(current_line[:-1])
-    return '\n'.join(lines)
-
-  @classmethod
-  def image_grid(cls, imgs, rows = 1, cols = 1, prompt = ""):
-    assert len(imgs) == rows*cols
+    current_line = []
+    # Measure every word once and keep a running width instead of
+    # re-measuring the whole line, so wrapping is linear in prompt length
+    space_width = font.getlength(" ")
+    line_width = 0
+    for word in text.split(" "):
+      word_width = font.getlength(word) + space_width
+      if current_line and line_width + word_width > max_width:
+        lines.append(" ".join(current_line))
+        current_line = []
+        line_width = 0
+      current_line.append(word)
+      line_width += word_width
+    lines.append(" ".join(current_line))
+    cls.layouts[key] = '\n'.join(lines)
+    while len(cls.layouts) > cls.layouts_size :
+      cls.layouts.popitem(last = False)
+    return cls.layouts[key]
+
+  @classmethod
+  def __write_png(cls, file, width, height, bands, **kwargs):
+    """
+    Stream RGB `bands` of shape (rows, `width`, 3) to `file` as a PNG
+
+    Every band is filtered and compressed as soon as it arrives, so the
+    full image never has to be held in memory
+    """
+    compress_level = kwargs.setdefault("compress_level", 6)
+    def write_chunk(tag, data):
+      file.write(pack(">I", len(data)) + tag + data + pack(">I", crc32(tag + data) & 0xffffffff))
+    file.write(b"\x89PNG\r\n\x1a\n")
+    write_chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    compressor = compressobj(compress_level)
+    for band in bands:
+      raw = numpy.asarray(band, dtype = "uint8").reshape(len(band), width * 3)
+      # PNG "Sub" filter : store each byte as the difference with the same channel of the previous pixel
+      scanlines = raw.copy()
+      scanlines[:, 3:] -= raw[:, :-3]
+      filter_type = numpy.full((len(band), 1), 1, dtype = "uint8")
+      data = compressor.compress(numpy.concatenate((filter_type, scanlines), axis = 1).tobytes())
+      if data :
+        write_chunk(b"IDAT", data)
+    write_chunk(b"IDAT", compressor.flush())
+    write_chunk(b"IEND", b"")
+
+  @classmethod
+  def __header_bands(cls, text, font, width, height, margin, band_height):
+    """
+    Yield the prompt header of the grid as NumPy arrays
+
+    Only the rows holding the text are drawn, the white padding around them
+    is streamed in bands of at most `band_height` rows
+    """
+    def padding(rows):
+      band = numpy.full((min(rows, band_height), width, 3), 255, dtype = "uint8")
+      for top in range(0, rows, band_height):
+        yield band[:min(band_height, rows - top)]
+    text_height = 0
+    if text and height > margin :
+      text_height = min(ImageDraw.Draw(Image.new('RGB', (1, 1))).multiline_textbbox((0, 0), text, font = font)[3], height - margin)
+    yield from padding(min(margin, height))
+    if text_height > 0 :
+      band = Image.new('RGB', size=(width, text_height), color=(255, 255, 255))
+      ImageDraw.Draw(band).text((margin, 0), text, font = font, fill=(0,0,0, 255))
+      yield numpy.asarray(band)
+    yield from padding(max(height - margin - text_height, 0))
+
+  @classmethod
+  def __grid_bands(cls, imgs, rows, cols, w, h):
+    """
+    Yield the grid one row of images at a time as NumPy arrays
+    """
+    imgs = iter(imgs)
+    count = 0
+    for _ in range(rows):
+      band = numpy.full((h, cols*w, 3), 255, dtype = "uint8")
+      for col, img in zip(range(cols), imgs):
+        tile = numpy.asarray(img if img.mode == "RGB" else img.convert("RGB"))[:h, :w]
+        band[:tile.shape[0], col*w:col*w + tile.shape[1]] = tile
+        count += 1
+      yield band
+    assert count == rows*cols and next(imgs, None) is None
+
+  @classmethod
+  def image_grid(cls, imgs, rows = 1, cols = 1, prompt = "", **kwargs):
+    output = kwargs.pop("output", None)
+    font_size = kwargs.pop("font_size", 30)
+    if hasattr(imgs, "__len__") :
+      assert len(imgs) == rows*cols
+    # `imgs` may be a generator, in which case only one row of source images is held at a time
+    imgs = iter(imgs)
+    first = next(imgs)
     text_margin = 40
-    w, h = imgs[0].size
-    prompt_height = h * rows // 2 - (2 * text_margin)
+    w, h = first.size
+    prompt_height = max(h * rows // 2 - (2 * text_margin), 0)
     prompt_width = cols*w - (2 * text_margin)
-    grid = Image.new('RGB', size=(cols*w, rows*h + prompt_height))
-    grid_w, grid_h = grid.size
-    grid.paste((255,255,255, 255), (0, 0, grid_w, grid_h))
-    draw = ImageDraw.Draw(grid)
-    # requires a newer version of pillow
-    # use a truetype font
-    font_path = join(cv2.__path__[0],'qt','fonts','DejaVuSans.ttf')
-    font_size = 30
-    font = ImageFont.truetype(font_path, font_size)
-    draw.text((text_margin, text_margin), cls.wrap_text(prompt, prompt_width, font), font = font, fill=(0,0,0, 255))
-    for i, img in enumerate(imgs):
-      grid.paste(img, box=(i%cols*w, prompt_height + (i//cols*h)))
+    grid_w, grid_h = cols*w, rows*h + prompt_height
+    font = cls.get_font(font_size)
+    bands = chain(
+      cls.__header_bands(cls.wrap_text(prompt, prompt_width, font), font, grid_w, prompt_height, text_margin, h),
+      cls.__grid_bands(chain((first,), imgs), rows, cols, w, h)
+    )
+    if output is not None :
+      # A generator with too few or too many images is only caught after the last band,
+      # so write to a temporary file and only move it to `output` once the grid is complete
+      try :
+        with open(f"{output}.tmp", "wb") as file :
+          cls.__write_png(file, grid_w, grid_h, bands, **kwargs)
+      except BaseException :
+        remove(f"{output}.tmp")
+        raise
+      replace(f"{output}.tmp", output)
+      return output
+    # Paste band by band into a single canvas, as a full NumPy copy would double the peak memory
+    grid = Image.new('RGB', size=(grid_w, grid_h))
+    top = 0
+    for band in bands:
+      grid.paste(Image.fromarray(band), (0, top))
+      top += len(band)
     return grid
 
+  @classmethod
+  def __to_array(cls, image):
+    """
+    Convert a decoded tensor or array in HWC or CHW layout to a HWC uint8 array
+
+    Float values are expected in the [0, 1] range, as returned by the pipeline with `output_type = "pt"`
+    """
+    if hasattr(image, "detach") :
+      image = image.detach().to("cpu")
+      if image.is_floating_point() :
+        image = image.float().clamp(0, 1).mul(255).round().to(torch.uint8)
+      image = image.numpy()
+    if image.ndim == 3 and image.shape[0] in (1, 3, 4) and image.shape[-1] not in (1, 3, 4) :
+      image = image.transpose(1, 2, 0)
+    if image.dtype != numpy.uint8 :
+      image = (numpy.clip(image, 0, 1) * 255).round().astype("uint8")
+    return numpy.ascontiguousarray(image[..., 0] if image.ndim == 3 and image.shape[-1] == 1 else image)
+
+  @classmethod
+  def encode_image(cls, image, index, output, image_format, options):
+    """
+    Encode a single image as `image_format` and write it to `output`, formatted with its `index`
+
+    This is the unit of work `save_images` submits to its executor. It is public so
+    it can be pickled by reference and run on a `ProcessPoolExecutor` as well.
+    """
+    start = perf_counter()
+    buffer = BytesIO()
+    if hasattr(image, "save") :
+      image.save(buffer, format = image_format, **options)
+    else :
+      image = cls.__to_array(image)
+      if image_format == "png" and image.ndim == 3 and image.shape[-1] == 3 :
+        # Encode straight from the array, without a round-trip through PIL
+        cls.__write_png(buffer, image.shape[1], image.shape[0], (image,), **options)
+      else :
+        Image.fromarray(image).save(buffer, format = image_format, **options)
+    data = buffer.getvalue()
+    encoded = perf_counter()
+    result = {
+      "index" : index,
+      "path" : None,
+      "data" : data,
+      "encode_time" : encoded - start,
+      "write_time" : 0
+    }
+    if output is not None :
+      result["path"] = output.format(index = index, format = image_format)
+      with open(result["path"], "wb") as file :
+        file.write(data)
+      result["data"] = None
+      result["write_time"] = perf_counter() - encoded
+    return result
+
+  @classmethod
+  def save_images(cls, images, **kwargs):
+    """
+    Encode and write `images` on a worker pool, yielding one result per image as soon as it is done
+
+    `images` may be PIL images, or tensors / arrays as decoded by the pipeline, in which case a
+    batch dimension is unrolled. Results are dicts with the `index` of the image, the `path` it
+    was written to (or its encoded `data` when `output` is None), its `encode_time` and its
+    `write_time`. At most `queue_size` images are queued at any time.
+    """
+    image_format = kwargs.pop("format", default["output"]["format"]).lower()
+    output = kwargs.pop("output", "image_{index:05d}.{format}")
+    workers = kwargs.pop("workers", default["output"]["workers"])
+    queue_size = kwargs.pop("queue_size", default["output"]["queue_size"])
+    executor = kwargs.pop("executor", None)
+    options = {**default["output"]["options"].get(image_format, {}), **kwargs}
+    if hasattr(images, "ndim") and images.ndim == 4 :
+      images = iter(images)
+    else :
+      images = chain.from_iterable(image if hasattr(image, "ndim") and image.ndim == 4 else (image,) for image in images)
+    pool = executor if executor is not None else futures.ThreadPoolExecutor(max_workers = workers)
+    pending = set()
+    try :
+      for index, image in enumerate(images):
+        if len(pending) >= queue_size :
+          done, pending = futures.wait(pending, return_when = futures.FIRST_COMPLETED)
+          for future in done:
+            yield future.result()
+        pending.add(pool.submit(cls.encode_image, image, index, output, image_format, options))
+      for future in futures.as_completed(pending):
+        yield future.result()
+    finally :
+      if executor is None :
+        pool.shutdown(wait = True, cancel_futures = True)
+
+  @classmethod
+  def __catalog(cls, **kwargs):
+    database = kwargs.pop("database", None) or default["catalog"]["database"]
+    create = kwargs.pop("create", False)
+    if not create and not isfile(database) :
+      return None
+    makedirs(dirname(database), exist_ok = True)
+    connection = connect(database)
+    if connection.execute("PRAGMA user_version").fetchone()[0] < cls.__catalog_version :
+      connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS tensors;")
+      connection.execute(f"PRAGMA user_version = {cls.__catalog_version}")
+    connection.executescript(cls.__catalog_schema)
+    return connection
+
+  @classmethod
+  def __catalog_key(cls, path):
+    return abspath(path) if isdir(path) else path
+
+  @classmethod
+  def __file_variant(cls, file_name):
+    # <weights>[.<variant>][-<shard>-of-<shards>].safetensors
+    return splitext(sub(r"-\d+-of-\d+$", "", splitext(file_name)[0]))[1][1:]
+
+  @classmethod
+  def __index_file(cls, connection, file_path, info, hash_contents):
+    directory = dirname(file_path)
+    file_name = basename(file_path)
+    if basename(directory) in default["merging"] :
+      # Diffusers layout : <model>/<component>/<weights files>
+      model, component = dirname(directory), basename(directory)
+      variant = cls.__file_variant(file_name)
+    else :
+      # Single file checkpoint
+      model, component, variant = file_path, "", ""
+    connection.execute("DELETE FROM tensors WHERE path = ?", (file_path,))
+    if file_name == "config.json" :
+      with open(file_path, "rb") as file :
+        data = file.read()
+      digest = sha256(data).hexdigest()
+      connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+        file_path, model, component, "", "config", info.st_mtime, info.st_size, None, digest, data.decode("utf-8")
+      ))
+      return
+    with open(file_path, "rb") as file :
+      length = int.from_bytes(file.read(8), "little")
+      header_bytes = file.read(length)
+      # The header holds every key, dtype, shape and offset : this tells checkpoints apart
+      # by layout only, two checkpoints with different weights can share it
+      layout_hash = sha256(header_bytes)
+      layout_hash.update(str(info.st_size).encode())
+      content_hash = None
+      if hash_contents == "full" :
+        content_hash = sha256()
+        file.seek(0)
+        for chunk in iter(lambda: file.read(1 << 24), b""):
+          content_hash.update(chunk)
+        content_hash = content_hash.hexdigest()
+    header = json.loads(header_bytes)
+    metadata = header.pop("__metadata__", {})
+    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+      file_path, model, component, variant, "safetensors", info.st_mtime, info.st_size, layout_hash.hexdigest(), content_hash, json.dumps(metadata)
+    ))
+    data_start = 8 + length
+    connection.executemany("INSERT INTO tensors VALUES (?, ?, ?, ?, ?, ?)", ((
+      file_path,
+      key,
+      tensor["dtype"],
+      json.dumps(tensor["shape"]),
+      data_start + tensor["data_offsets"][0],
+      data_start + tensor["data_offsets"][1]
+    ) for key, tensor in header.items()))
+
+  @classmethod
+  def __refresh_catalog(cls, connection, path, name):
+    """
+    Bring the rows of component `name` of the model at `path` up to date with the files on disk
+
+    Files whose mtime or size changed are indexed again, files that disappeared are dropped and
+    files that appeared in the component directory are added
+    """
+    model = cls.__catalog_key(path)
+    known = {file_path : (mtime, size) for file_path, mtime, size in connection.execute(
+      "SELECT path, mtime, size FROM files WHERE model = ? AND component = ?", (model, name)
+    )}
+    if not known :
+      return
+    file_paths = set(known)
+    if isdir(join(model, name)) :
+      file_paths.update(join(model, name, file_name) for file_name in listdir(join(model, name))
+        if file_name.endswith(".safetensors") or file_name == "config.json")
+    with connection :
+      for file_path in file_paths:
+        try :
+          info = stat(file_path)
+        except OSError :
+          connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+          connection.execute("DELETE FROM tensors WHERE path = ?", (file_path,))
+          continue
+        if known.get(file_path) != (info.st_mtime, info.st_size) :
+          logger.info(f"Indexing {file_path}")
+          cls.__index_file(connection, file_path, info, None)
+
+  @classmethod
+  def scan_catalog(cls, *args, **kwargs):
+    """
+    Index the safetensors headers and component configs of every checkpoint below the directories in `args`
+
+    The index lives in a small SQLite database (`default["catalog"]["database"]` unless `database`
+    is given). Files are only read again when their mtime or size changed since the previous scan,
+    and files that disappeared are dropped. Every weights file gets a `layout_hash` of its header, which
+    only tells checkpoints apart by keys, dtypes and shapes. With `hash = "full"` the whole file is
+    read as well, to record the `hash` of its contents. Returns how many files were indexed, unchanged
+    and removed.
+    """
+    hash_contents = kwargs.pop("hash", default["catalog"]["hash"])
+    connection = cls.__catalog(create = True, **kwargs)
+    counts = {"indexed" : 0, "unchanged" : 0, "removed" : 0}
+    try :
+      with connection :
+        for root in args:
+          root = join(abspath(root), "")
+          known = {}
+          for path, mtime, size, content_hash in connection.execute(
+            "SELECT path, mtime, size, hash FROM files WHERE substr(path, 1, ?) = ?", (len(root), root)
+          ):
+            # Files indexed without their content hash are read again when it is asked for
+            known[path] = None if hash_contents == "full" and content_hash is None else (mtime, size)
+          seen = set()
+          for directory, _, file_names in walk(root, followlinks = True):
+            for file_name in file_names:
+              if not file_name.endswith(".safetensors") and not (file_name == "config.json" and basename(directory) in default["merging"]) :
+                continue
+              file_path = join(directory, file_name)
+              seen.add(file_path)
+              info = stat(file_path)
+              if known.get(file_path) == (info.st_mtime, info.st_size) :
+                counts["unchanged"] += 1
+                continue
+              logger.info(f"Indexing {file_path}")
+              cls.__index_file(connection, file_path, info, hash_contents)
+              counts["indexed"] += 1
+          for file_path in set(known) - seen:
+            connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+            connection.execute("DELETE FROM tensors WHERE path = ?", (file_path,))
+            counts["removed"] += 1
+    finally :
+      connection.close()
+    return counts
+
+  @classmethod
+  def catalog_variants(cls, *args, **kwargs):
+    """
+    Variants of component `name` available for the model at `path` according to the catalog
+    `""` stands for the default variant. Returns None when the model is not in the catalog.
+    Like every catalog lookup, it first refreshes the rows of files changed since the last scan.
+    """
+    path, *_ = list(args) + [None]
+    name = kwargs.pop("name", "unet")
+    connection = cls.__catalog(**kwargs)
+    if connection is None :
+      return None
+    try :
+      cls.__refresh_catalog(connection, path, name)
+      variants = [variant for variant, in connection.execute(
+        "SELECT DISTINCT variant FROM files WHERE model = ? AND component = ? AND kind = 'safetensors'",
+        (cls.__catalog_key(path), name)
+      )]
+    finally :
+      connection.close()
+    return sorted(variants) if variants else None
+
+  @classmethod
+  def catalog_config(cls, *args, **kwargs):
+    path, *_ = list(args) + [None]
+    name = kwargs.pop("name", "unet")
+    connection = cls.__catalog(**kwargs)
+    if connection is None :
+      return None
+    try :
+      cls.__refresh_catalog(connection, path, name)
+      row = connection.execute(
+        "SELECT data FROM files WHERE model = ? AND component = ? AND kind = 'config'",
+        (cls.__catalog_key(path), name)
+      ).fetchone()
+    finally :
+      connection.close()
+    return json.loads(row[0]) if row else None
+
+  @classmethod
+  def catalog_tensors(cls, *args, **kwargs):
+    """
+    Keys of component `name` of the model at `path`, mapped to their dtype, shape, file and byte offsets
+
+    Without `variant`, the variant used for inference is picked when available, the default
+    variant otherwise. Returns None when the model is not in the catalog.
+    """
+    path, *_ = list(args) + [None]
+    name = kwargs.pop("name", "unet")
+    variant = kwargs.pop("variant", None)
+    if variant is None :
+      variants = cls.catalog_variants(path, name = name, **kwargs)
+      if not variants :
+        return None
+      preferred = default["inference"]["variant"]
+      variant = preferred if preferred in variants else "" if "" in variants else variants[0]
+    connection = cls.__catalog(**kwargs)
+    try :
+      cls.__refresh_catalog(connection, path, name)
+      rows = connection.execute("""
+        SELECT tensors.key, tensors.dtype, tensors.shape, tensors.path, tensors.start, tensors.end
+        FROM files JOIN tensors ON files.path = tensors.path
+        WHERE files.model = ? AND files.component = ? AND files.variant = ?
+      """, (cls.__catalog_key(path), name, variant)).fetchall()
+    finally :
+      connection.close()
+    return {key : {
+      "dtype" : dtype,
+      "shape" : tuple(json.loads(shape)),
+      "path" : file_path,
+      "start" : start,
+      "end" : end
+    } for key, dtype, shape, file_path, start, end in rows} or None
+
+  @classmethod
+  def check_compatibility(cls, model_a_name, model_b_name, **kwargs):
+    """
+    Compare component `model` of two checkpoints using only the catalog, without loading any weights
+
+    Returns the keys of A missing from B, the keys whose shapes differ and, unless
+    `skip_config_check` is set, the mismatched config keys. Returns None when either
+    checkpoint is not in the catalog.
+    """
+    model = kwargs.setdefault("model", "unet")
+    skip_config_check = kwargs.setdefault("skip_config_check", default["merging"][model]["skip_config_check"])
+    database = kwargs.setdefault("database", None)
+    tensors_a = cls.catalog_tensors(model_a_name, name = model, database = database)
+    tensors_b = cls.catalog_tensors(model_b_name, name = model, database = database)
+    if tensors_a is None or tensors_b is None :
+      return None
+    result = {
+      "missing" : [key for key in tensors_a if key not in tensors_b],
+      "mismatched" : {key : (tensor["shape"], tensors_b[key]["shape"]) for key, tensor in tensors_a.items() if key in tensors_b and tensor["shape"] != tensors_b[key]["shape"]},
+      "config" : set()
+    }
+    if not skip_config_check :
+      config_a = cls.catalog_config(model_a_name, name = model, database = database)
+      config_b = cls.catalog_config(model_b_name, name = model, database = database)
+      if config_a is not None and config_b is not None :
+        result["config"] = cls.__compare_configs(config_a, config_b, cls.__config_keys_to_skip)
+    return result
+
+  @classmethod
+  def __check_catalog_compatibility(cls, model_a_name, model_b_name, model, skip_config_check):
+    compatibility = cls.check_compatibility(model_a_name, model_b_name, model = model, skip_config_check = skip_config_check)
+    if compatibility is None :
+      return
+    if compatibility["config"] :
+      raise ValueError(f"{model.capitalize()} models cannot be merged due to configuration differences: {', '.join(sorted(compatibility['config']))}")
+    if compatibility["missing"] :
+      raise ValueError(f"Key {compatibility['missing'][0]} not found in {model} B")
+    if compatibility["mismatched"] :
+      key, (shape_a, shape_b) = next(iter(compatibility["mismatched"].items()))
+      raise ValueError(f"Shape mismatch for key {key}: A: {shape_a}, B: {shape_b}")
+
   @classmethod
   def __load_component_from_config(cls, config, **kwargs):
     name = kwargs.setdefault("name", "unet")
@@ -270,20 +1129,25 @@ class ComposableStableDiffusionXLPipeline:
   @classmethod
   def __get_component(cls, path, **kwargs):
     name = kwargs.setdefault("name", "unet")
-    if path in cls.path :
+    skip_load_from_memory = kwargs.setdefault("skip_load_from_memory", False)
+    if path in cls.path and not skip_load_from_memory :
       return getattr(cls.path[path][2], name)
     else :
       try :
         inference = default["inference"].copy()
-        return default["merging"][name]["model"].from_pretrained(path, **inference, **{
+        variants = cls.catalog_variants(path, name = name)
+        if variants and inference["variant"] not in variants :
+          # The catalog already knows the preferred variant does not exist
+          inference.pop("variant")
+        return cls.__record_source(default["merging"][name]["model"].from_pretrained(path, **inference, **{
           "subfolder" : name
-        })
+        }), path, name, inference.get("variant", ""))
       except :
         logger.info("Logging default variant instead")
-        inference.pop("variant")
-        return default["merging"][name]["model"].from_pretrained(path, **inference, **{
+        inference.pop("variant", None)
+        return cls.__record_source(default["merging"][name]["model"].from_pretrained(path, **inference, **{
           "subfolder" : name
-        }).to(dtype=default["inference"]["torch_dtype"])
+        }).to(dtype=default["inference"]["torch_dtype"]), path, name, "")
 
   @classmethod
   def __compare_configs(cls, config_a, config_b, skip_keys):
@@ -297,21 +1161,12 @@ class ComposableStableDiffusionXLPipeline:
     return mismatched_keys
 
   @classmethod
-  def merge(cls, model_a_name, model_b_name, **kwargs):
-    model = kwargs.setdefault("model", "unet")
-    alpha = kwargs.setdefault("alpha", default["merging"][model]["alpha"])
-    skip_config_check = kwargs.setdefault("skip_config_check", default["merging"][model]["skip_config_check"])
-    torch_dtype = kwargs.setdefault("torch_dtype", default["inference"]["torch_dtype"])
-
-    model_a = cls.__get_component(model_a_name, name = model)
-    model_b = cls.__get_component(model_b_name, name = model)
-
+  def __check_compatibility(cls, model_a, model_b, model, skip_config_check):
     logger.info(f"Verifying {model} model compatibility...")
-    keys_to_skip = {"_diffusers_version", "_name_or_path", "_use_default_values"}
 
     if not skip_config_check:
       # Compare configs
-      mismatched_keys = cls.__compare_configs(model_a.config, model_b.config, keys_to_skip)
+      mismatched_keys = cls.__compare_configs(model_a.config, model_b.config, cls.__config_keys_to_skip)
 
       if mismatched_keys:
         logger.error(f"{model.capitalize()} models have different configurations. Mismatched keys:")
@@ -321,6 +1176,36 @@ class ComposableStableDiffusionXLPipeline:
 
       logger.info(f"{model.capitalize()} models are compatible.")
 
+  @classmethod
+  def __build_component(cls, config, state_dict, **kwargs):
+    model = kwargs.setdefault("model", "unet")
+    torch_dtype = kwargs.setdefault("torch_dtype", default["inference"]["torch_dtype"])
+    logger.info(f"Creating merged {model} model...")
+    with init_empty_weights():
+      merged_model = cls.__load_component_from_config(config, name = model)
+
+    try :
+      load_model_dict_into_meta(merged_model, state_dict, device = cls.device, dtype = torch_dtype)
+    except TypeError :
+      # diffusers 0.33 and later take a device map instead of a device
+      load_model_dict_into_meta(merged_model, state_dict, device_map = {"" : cls.device}, dtype = torch_dtype)
+
+    return merged_model
+
+  @classmethod
+  def merge(cls, model_a_name, model_b_name, **kwargs):
+    model = kwargs.setdefault("model", "unet")
+    alpha = kwargs.setdefault("alpha", default["merging"][model]["alpha"])
+    skip_config_check = kwargs.setdefault("skip_config_check", default["merging"][model]["skip_config_check"])
+    torch_dtype = kwargs.setdefault("torch_dtype", default["inference"]["torch_dtype"])
+
+    cls.__check_catalog_compatibility(model_a_name, model_b_name, model, skip_config_check)
+
+    model_a = cls.__get_component(model_a_name, name = model)
+    model_b = cls.__get_component(model_b_name, name = model)
+
+    cls.__check_compatibility(model_a, model_b, model, skip_config_check)
+
     merged_state_dict = {}
 
     for key in logging.tqdm(model_a.state_dict().keys(), desc=f"Merging {model} models"):
@@ -341,10 +1226,296 @@ class ComposableStableDiffusionXLPipeline:
       del tensor_b
       empty_cache()
 
-    logger.info(f"Creating merged {model} model...")
-    with init_empty_weights():
-      merged_model = cls.__load_component_from_config(model_a.config, name = model)
+    return cls.__build_component(model_a.config, merged_state_dict, model = model, torch_dtype = torch_dtype)
 
-    load_model_dict_into_meta(merged_model, merged_state_dict, device = cls.device, dtype = default["inference"]["torch_dtype"])
+  @classmethod
+  def merge_sweep(cls, model_a_name, model_b_name, alphas, **kwargs):
+    """
+    Yield `(alpha, merged_model)` for every alpha in `alphas`
 
-    return merged_model
+    Both models are loaded only once and kept on the device. A single merged model stays
+    resident and is updated in place to `(1 - alpha) * A + alpha * B` for every alpha, exactly
+    as `merge` computes it, so use it (e.g. generate with it) before advancing to the next alpha.
+    """
+    model = kwargs.setdefault("model", "unet")
+    skip_config_check = kwargs.setdefault("skip_config_check", default["merging"][model]["skip_config_check"])
+    torch_dtype = kwargs.setdefault("torch_dtype", default["inference"]["torch_dtype"])
+
+    cls.__check_catalog_compatibility(model_a_name, model_b_name, model, skip_config_check)
+
+    model_a = cls.__get_component(model_a_name, name = model)
+    model_b = cls.__get_component(model_b_name, name = model)
+
+    cls.__check_compatibility(model_a, model_b, model, skip_config_check)
+
+    state_dict_a = model_a.state_dict()
+    state_dict_b = model_b.state_dict()
+    base = {}
+    other = {}
+
+    with torch.no_grad():
+      for key in logging.tqdm(state_dict_a.keys(), desc=f"Preparing {model} models"):
+        if key not in state_dict_b:
+          raise ValueError(f"Key {key} not found in {model} B")
+
+        tensor_a = state_dict_a[key].to(cls.device)
+        tensor_b = state_dict_b[key].to(cls.device)
+
+        if tensor_a.shape != tensor_b.shape:
+          raise ValueError(f"Shape mismatch for key {key}: A: {tensor_a.shape}, B: {tensor_b.shape}")
+
+        base[key] = tensor_a
+        if tensor_a.is_floating_point() :
+          # B is kept as is rather than as a difference, which would round both ends of the sweep
+          other[key] = tensor_b
+
+    del model_b, state_dict_b
+    cls.flush()
+
+    # The resident model gets its own copy of A, so that A itself is never modified
+    merged_model = cls.__build_component(model_a.config, {key : tensor.clone() for key, tensor in base.items()}, model = model, torch_dtype = torch_dtype)
+
+    for alpha in alphas:
+      logger.info(f"Updating merged {model} model to alpha {alpha}")
+      # Look the tensors up again for every alpha, as moving or casting the merged model
+      # in between (e.g. when composing a pipeline around it) replaces them
+      tensors = dict(chain(merged_model.named_parameters(remove_duplicate = False), merged_model.named_buffers(remove_duplicate = False)))
+      with torch.no_grad():
+        for key, tensor in other.items():
+          tensors[key].copy_((1 - alpha) * base[key] + alpha * tensor)
+      yield alpha, merged_model
+
+  @classmethod
+  def __resident_memory(cls):
+    # Without /proc there is no way to sample the current resident size, only the peak of
+    # the whole process so far, which says nothing about a single stage
+    try :
+      with open("/proc/self/statm") as file :
+        return int(file.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except OSError :
+      return None
+
+  @classmethod
+  @contextmanager
+  def __measure(cls, stats, stage):
+    """
+    Record the duration and the peak resident memory of `stage` into `stats`
+
+    The peak memory is left out where the resident memory cannot be sampled (without /proc)
+    """
+    peak = [cls.__resident_memory()]
+    done = Event()
+    def sample():
+      while not done.wait(0.005):
+        peak[0] = max(peak[0], cls.__resident_memory())
+    sampler = Thread(target = sample, daemon = True) if peak[0] is not None else None
+    if cuda_is_available :
+      reset_peak_memory_stats()
+    start = perf_counter()
+    if sampler is not None :
+      sampler.start()
+    try :
+      yield
+    finally :
+      # A stage that runs more than once (e.g. once per batch) adds up its time and keeps its highest peak
+      measured = stats.setdefault(stage, {"time" : 0})
+      measured["time"] += perf_counter() - start
+      if sampler is not None :
+        done.set()
+        sampler.join()
+        measured["peak_memory"] = max(measured.get("peak_memory", 0), peak[0], cls.__resident_memory())
+      if cuda_is_available :
+        measured["peak_cuda_memory"] = max(measured.get("peak_cuda_memory", 0), max_memory_allocated())
+
+  @classmethod
+  def __decode(cls, pipeline, latents, **kwargs):
+    output_type = kwargs.setdefault("output_type", "pil")
+    tiling = kwargs.setdefault("tiling", False)
+    vae = pipeline.vae
+    if isinstance(vae, LazyComponent) :
+      vae = vae.load()
+    # make sure the VAE is in float32 mode, as it overflows in float16
+    needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+    if needs_upcasting :
+      vae.to(dtype = torch.float32)
+    latents = latents.to(device = cls.device, dtype = torch.float32 if needs_upcasting else vae.dtype)
+    if getattr(vae.config, "latents_mean", None) is not None and getattr(vae.config, "latents_std", None) is not None :
+      latents_mean = torch.tensor(vae.config.latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+      latents_std = torch.tensor(vae.config.latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+      latents = latents * latents_std / vae.config.scaling_factor + latents_mean
+    else :
+      latents = latents / vae.config.scaling_factor
+    was_tiling = vae.use_tiling
+    tile_sizes = (vae.tile_sample_min_size, vae.tile_latent_min_size)
+    if tiling :
+      vae.enable_tiling()
+      if tiling is not True :
+        # Tiles default to the training size of the VAE, which only tiles images larger than that
+        vae.tile_sample_min_size = tiling
+        vae.tile_latent_min_size = tiling // 2 ** (len(vae.config.block_out_channels) - 1)
+    try :
+      with torch.no_grad():
+        image = vae.decode(latents, return_dict = False)[0]
+    finally :
+      vae.tile_sample_min_size, vae.tile_latent_min_size = tile_sizes
+      if tiling and not was_tiling :
+        vae.disable_tiling()
+      if needs_upcasting :
+        vae.to(dtype = torch.float16)
+    if getattr(pipeline, "watermark", None) is not None :
+      image = pipeline.watermark.apply_watermark(image)
+    return pipeline.image_processor.postprocess(image, output_type = output_type)
+
+  @classmethod
+  def __generate_in_stages(cls, pipeline, batches, settings, stats, **kwargs):
+    """
+    Run the UNet for all `batches`, then the VAE for all of them, releasing lazy components as soon as their stage is done
+    """
+    output_type = kwargs.pop("output_type", "pil")
+    if settings["sequential"] :
+      cls.release(components = ["text_encoder", "text_encoder_2"])
+    latents = []
+    with cls.__measure(stats, "unet"):
+      attention_slice = settings["attention_slice"]
+      if attention_slice is not None :
+        processors = pipeline.unet.attn_processors
+        pipeline.unet.set_attention_slice(attention_slice)
+      try :
+        for embeddings, generators in batches:
+          latents.append(pipeline(**embeddings, **kwargs, generator = generators, output_type = "latent").images)
+      finally :
+        if attention_slice is not None :
+          pipeline.unet.set_attn_processor(processors)
+    if settings["sequential"] :
+      cls.release(components = ["unet"])
+    if output_type == "latent" :
+      return latents
+    images = []
+    with cls.__measure(stats, "vae"):
+      for batch in latents:
+        images.append(cls.__decode(pipeline, batch, output_type = output_type, tiling = settings["vae_tiling"]))
+    if settings["sequential"] :
+      cls.release(components = ["vae"])
+    return images
+
+  @classmethod
+  def __draw_seed(cls):
+    return int(torch.randint(0, 2 ** 32, (1,), generator = cls.generator, device = cls.generator.device))
+
+  @classmethod
+  def generate(cls, *args, **kwargs):
+    """
+    Generate images for `prompt` with the current model
+
+    Every image has its own seed and its own generator, so a batch starts from exactly the
+    noise the same seeds would give one by one. `prompt` may be a list with one prompt per
+    image, and `seeds` a list with one seed per image. A single `seed` gives seeds `seed`,
+    `seed + 1`, and so on; images without a seed get one drawn from the shared `generator`.
+    By default every image is run on its own, which gives bit-identical images however they
+    are requested. With a larger `batch_size` (or None, for no limit), images whose prompt
+    embeddings have the same shape are run together, which is faster but not bit-identical :
+    batched kernels round differently, so pixels may differ by a few levels (up to about
+    4 / 255 in half precision). The seeds that were used are returned in the stats as `seeds`.
+
+    `profile` selects one of `default["profiles"]` (or is a profile dict itself). The
+    "low_memory" profile runs the text encoders, the UNet and the VAE one after the other,
+    with chunked attention and a VAE decode in tiles of `vae_tiling` pixels, and needs a lazy model (see `load_model`)
+    so that each component is only loaded during its own stage; components that are not lazy
+    stay resident. With `return_stats`, the time and peak resident memory (where /proc is
+    available) of every stage are returned along with the images. Prompt embeddings are
+    read from `embeddings` (see `precompute_embeddings`) when they are stored there, or can be
+    passed directly as `prompt_embeds`, `negative_prompt_embeds`, `pooled_prompt_embeds` and
+    `negative_pooled_prompt_embeds` for a single prompt, in which case `prompt` is ignored.
+    """
+    prompt, *_ = list(args) + [kwargs.pop("prompt", None)]
+    seed = kwargs.pop("seed", None)
+    seeds = kwargs.pop("seeds", None)
+    images_per_prompt = kwargs.pop("num_images_per_prompt", 1)
+    batch_size = kwargs.pop("batch_size", 1)
+    profile = kwargs.pop("profile", default["profile"])
+    return_stats = kwargs.pop("return_stats", False)
+    settings = {**default["profiles"]["default"], **(default["profiles"][profile] if isinstance(profile, str) else profile)}
+    prompt_options = {key : kwargs.pop(key) for key in (
+      "prompt_2",
+      "negative_prompt",
+      "negative_prompt_2",
+      "embeddings"
+    ) if key in kwargs}
+    given = {key : kwargs.pop(key) for key in (
+      "prompt_embeds",
+      "negative_prompt_embeds",
+      "pooled_prompt_embeds",
+      "negative_pooled_prompt_embeds"
+    ) if key in kwargs}
+    if given :
+      prompt = None
+    prompts = [item for item in (prompt if isinstance(prompt, (list, tuple)) else [prompt]) for _ in range(images_per_prompt)]
+    if seeds is None :
+      seeds = [None if seed is None else seed + i for i in range(len(prompts))]
+    elif len(prompts) == 1 :
+      prompts = prompts * len(seeds)
+    if len(seeds) != len(prompts) :
+      raise ValueError(f"Got {len(seeds)} seeds for {len(prompts)} images")
+    seeds = [cls.__draw_seed() if item is None else item for item in seeds]
+    pipeline = cls.current[2]
+    if settings["sequential"] :
+      resident = [name for name in default["merging"] if not isinstance(getattr(pipeline, name, None), LazyComponent)]
+      if len(resident) == len(default["merging"]) :
+        raise ValueError("Running the stages one after the other needs a lazy model, load it with `lazy = True`")
+      if resident :
+        logger.warning(f"Components {', '.join(resident)} are not lazy and stay resident during every stage")
+    stats = {"seeds" : seeds}
+    embeddings = {}
+    with cls.__measure(stats, "text_encoders"):
+      for item in prompts:
+        if item not in embeddings :
+          embeddings[item] = given or cls.prompt_fix(item, **prompt_options)
+    # Images can only share a batch when their (weighted, possibly multi-chunk) embeddings have the same shape
+    groups = {}
+    for i, item in enumerate(prompts):
+      groups.setdefault(tuple(embeddings[item]["prompt_embeds"].shape), []).append(i)
+    groups = [group[i:i + (batch_size or len(group))] for group in groups.values() for i in range(0, len(group), batch_size or len(group))]
+    batches = [({
+      name : torch.cat([embeddings[prompts[i]][name] for i in group]) for name in embeddings[prompts[group[0]]]
+    }, [torch.Generator(device = cls.device).manual_seed(seeds[i]) for i in group]) for group in groups]
+    if settings["sequential"] or settings["vae_tiling"] or settings["attention_slice"] is not None :
+      outputs = cls.__generate_in_stages(pipeline, batches, settings, stats, **kwargs)
+    else :
+      with cls.__measure(stats, "unet_and_vae"):
+        outputs = [pipeline(**batch, **kwargs, generator = generators).images for batch, generators in batches]
+    images = [None] * len(prompts)
+    for group, output in zip(groups, outputs):
+      for i, image in zip(group, output):
+        images[i] = image
+    if hasattr(outputs[0], "shape") :
+      images = numpy.stack(images) if isinstance(outputs[0], numpy.ndarray) else torch.stack(images)
+    return (images, stats) if return_stats else images
+
+  @classmethod
+  def alpha_sweep(cls, model_a_name, model_b_name, alphas, **kwargs):
+    """
+    Generate one image per alpha in `alphas` with the same seed, merging `model` in place in between
+
+    A composite named `name` (by default "`model_a_name` + `model_b_name` (`model`)") is composed
+    from `model_a_name` around the resident merged model and stays loaded afterwards, holding the
+    last alpha. A later sweep with the same `name` swaps its merged model into that composite.
+    Images are returned in the order of `alphas`, ready to be passed to `image_grid`.
+    """
+    model = kwargs.pop("model", "unet")
+    name = kwargs.pop("name", None) or f"{model_a_name} + {model_b_name} ({model})"
+    seed = kwargs.pop("seed", 0)
+    merging = {key : kwargs.pop(key) for key in ("skip_config_check", "torch_dtype") if key in kwargs}
+    composite = cls.__get_model_from_store(name, by_name = True)
+    if composite is not None and composite[0] is not None :
+      raise Exception(f"Model '{name}' is not a composite model")
+    images = []
+    for i, (alpha, merged_model) in enumerate(cls.merge_sweep(model_a_name, model_b_name, alphas, model = model, **merging)):
+      if i == 0 :
+        if composite is None :
+          cls.compose(model_a_name, name = name, **{model : merged_model})
+        else :
+          setattr(composite[2], model, merged_model.to(dtype = default["inference"]["torch_dtype"]))
+          cls.current = composite
+          cls.flush()
+      images.extend(cls.generate(seed = seed, **kwargs))
+    return images
@@ -0,0 +1,48 @@
+from stablediffusers.util import module
+
+join, isfile = module("os.path", ["join", "isfile"])
+stat = module("os", "stat")
+json = module("json")
+sha256 = module("hashlib", "sha256")
+numpy = module("numpy")
+torch = module("torch")
+
+class EmbeddingStore:
+  """
+  Prompt embeddings kept in one memory-mapped file, indexed by prompt and negative prompt
+
+  Lookups return tensors that are views into the file, so they neither copy data nor run
+  the text encoders. `encoder` identifies the text encoders the embeddings were made with.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(join(path, "index.json"), encoding = "utf-8") as file :
+      index = json.load(file)
+    self.encoder = index["encoder"]
+    self.entries = index["entries"]
+    data_path = join(path, "embeddings.bin")
+    # Copy-on-write, so tensors are writable views that never modify the file
+    self.data = numpy.memmap(data_path, dtype = "uint8", mode = "c") if isfile(data_path) and stat(data_path).st_size else None
+
+  @staticmethod
+  def key(prompt, negative_prompt = ""):
+    return sha256(json.dumps([prompt, negative_prompt]).encode("utf-8")).hexdigest()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, prompt, negative_prompt = "", encoder = None):
+    """
+    Embeddings for `prompt` and `negative_prompt`, or None if they are not stored or `encoder` does not match
+    """
+    if encoder is not None and encoder != self.encoder :
+      return None
+    entry = self.entries.get(self.key(prompt, negative_prompt))
+    if entry is None :
+      return None
+    return {name : torch.from_numpy(self.data[start:end]).view(getattr(torch, dtype)).reshape(shape)
+      for name, (start, end, dtype, shape) in entry["tensors"].items()}
@@ -0,0 +1,65 @@
+from stablediffusers.util import module
+
+RLock = module("threading", "RLock")
+perf_counter = module("time", "perf_counter")
+
+class LazyComponent:
+  """
+  Placeholder for a pipeline component that is only loaded when it is first used
+
+  `config` and `dtype` are answered without loading any weights. Calling the component or
+  accessing any other attribute loads it through `loader`, and `release()` drops it again
+  until its next use. `source` records where the weights are loaded from, if known.
+  """
+
+  def __init__(self, loader, config = None, torch_dtype = None, source = None):
+    self.source = source
+    self._loader = loader
+    self._config_loader = config
+    self._config = None
+    self._torch_dtype = torch_dtype
+    self._module = None
+    self._lock = RLock()
+    self.last_used = None
+
+  @property
+  def is_loaded(self):
+    return self._module is not None
+
+  @property
+  def config(self):
+    if self._module is not None :
+      return self._module.config
+    if self._config is None :
+      self._config = self._config_loader() if self._config_loader is not None else self.load().config
+    return self._config
+
+  @property
+  def dtype(self):
+    if self._module is None and self._torch_dtype is not None :
+      return self._torch_dtype
+    return self.load().dtype
+
+  def load(self):
+    with self._lock :
+      if self._module is None :
+        self._module = self._loader()
+      self.last_used = perf_counter()
+      return self._module
+
+  def release(self):
+    with self._lock :
+      released = self._module is not None
+      self._module = None
+      return released
+
+  def __getattr__(self, key):
+    # Private attributes are only probed for (e.g. hooks and caches by diffusers), which must not load the component
+    if key.startswith("_") :
+      if key in ("_loader", "_config_loader", "_config", "_torch_dtype", "_module", "_lock") or self._module is None :
+        raise AttributeError(key)
+      return getattr(self._module, key)
+    return getattr(self.load(), key)
+
+  def __call__(self, *args, **kwargs):
+    return self.load()(*args, **kwargs)
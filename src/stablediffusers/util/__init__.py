@@ -5,6 +5,7 @@ from pathlib import PurePath
 from importlib import import_module, util
 from types import ModuleType, FrameType
 from itertools import chain, islice
+from threading import RLock
 import pprint
 from inspect import stack
 import inspect
@@ -335,7 +336,7 @@ def module(module, attrs = None) :
       return instance.__storage__.get_by_proxy(self.name)
 
   class Module_proxy_shared() :
-    __slots__ = ['dependency', 'activated', 'module_name', 'module_name', 'attribute_names', 'attributes_proxy', 'proxy']
+    __slots__ = ['dependency', 'activated', 'module_name', 'module_name', 'attribute_names', 'attributes_proxy', 'proxy', 'lock']
 
     def get_by_proxy(self, value) :
       if not self.activated :
@@ -347,6 +348,8 @@ def module(module, attrs = None) :
       self.module_name = name
       self.dependency = []
       self.activated = False
+      # Proxies may be first used from several threads at once
+      self.lock = RLock()
       self.proxy = proxy
       self.attributes_proxy = {}
       if not attrs :
@@ -375,21 +378,23 @@ def module(module, attrs = None) :
       return getattr(self.dependency, attr)
 
     def activate(self) :
-      if not self.activated :
-        self.activated = True
-        print("ACTIVATE")
-        mod = get_mod(self.module_name, self.attribute_names)
-        if not self.attribute_names :
-          self.dependency = mod
-        else :
-          self.dependency = lambda:None
-          for key in self.attribute_names :
-            attr = getattr(mod, key)
-            delattr(self.proxy, key)
-            setattr(self.dependency, key, attr)
-          self.attributes_proxy = None
-          self.proxy = None
-        print(self.dependency)
+      with self.lock :
+        if not self.activated :
+          print("ACTIVATE")
+          mod = get_mod(self.module_name, self.attribute_names)
+          if not self.attribute_names :
+            self.dependency = mod
+          else :
+            self.dependency = lambda:None
+            for key in self.attribute_names :
+              attr = getattr(mod, key)
+              delattr(self.proxy, key)
+              setattr(self.dependency, key, attr)
+            self.attributes_proxy = None
+            self.proxy = None
+          # Only flag as activated once the dependency is complete
+          self.activated = True
+          print(self.dependency)
       return
 
   class Module_proxy_child() :
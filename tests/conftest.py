@@ -0,0 +1,106 @@
+from os.path import abspath, dirname, join
+import json
+import sys
+
+import pytest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "src"))
+
+
+def byte_characters():
+  # the printable characters CLIP's byte level BPE maps every byte to
+  printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+  characters = printable + [256 + i for i, byte in enumerate(byte for byte in range(256) if byte not in printable)]
+  return [chr(character) for character in characters]
+
+
+def tiny_unet():
+  from diffusers import UNet2DConditionModel
+  return UNet2DConditionModel(
+    block_out_channels = (2, 4), layers_per_block = 1, sample_size = 8, in_channels = 4, out_channels = 4,
+    down_block_types = ("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types = ("CrossAttnUpBlock2D", "UpBlock2D"),
+    attention_head_dim = (2, 4), use_linear_projection = True, addition_embed_type = "text_time", addition_time_embed_dim = 8,
+    transformer_layers_per_block = (1, 2), projection_class_embeddings_input_dim = 80, cross_attention_dim = 64, norm_num_groups = 1
+  )
+
+
+@pytest.fixture(autouse = True)
+def catalog(tmp_path, monkeypatch):
+  """
+  Keep every test away from the catalog in the home directory
+  """
+  from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+  database = str(tmp_path / "catalog.db")
+  monkeypatch.setitem(sys.modules[Pipeline.__module__].default["catalog"], "database", database)
+  return database
+
+
+@pytest.fixture(scope = "session")
+def tiny_sdxl(tmp_path_factory):
+  """
+  A tiny SDXL checkpoint with random weights, small enough to run on CPU in a few seconds
+  """
+  torch = pytest.importorskip("torch")
+  from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline
+  from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+  path = tmp_path_factory.mktemp("tiny-sdxl")
+  characters = byte_characters()
+  vocab = {token : i for i, token in enumerate(characters + [character + "</w>" for character in characters] + ["<|startoftext|>", "<|endoftext|>"])}
+  with open(path / "vocab.json", "w", encoding = "utf-8") as file :
+    json.dump(vocab, file)
+  with open(path / "merges.txt", "w", encoding = "utf-8") as file :
+    file.write("#version: 0.2\n")
+  tokenizer = CLIPTokenizer(str(path / "vocab.json"), str(path / "merges.txt"), model_max_length = 77, pad_token = "<|endoftext|>")
+  text_config = CLIPTextConfig(
+    bos_token_id = len(vocab) - 2, eos_token_id = len(vocab) - 1, pad_token_id = 1, vocab_size = len(vocab),
+    hidden_size = 32, intermediate_size = 37, num_attention_heads = 4, num_hidden_layers = 2, projection_dim = 32, hidden_act = "gelu"
+  )
+  torch.manual_seed(0)
+  pipeline = StableDiffusionXLPipeline(
+    unet = tiny_unet(),
+    vae = AutoencoderKL(
+      block_out_channels = [8, 16], in_channels = 3, out_channels = 3, latent_channels = 4, norm_num_groups = 8, sample_size = 64,
+      down_block_types = ["DownEncoderBlock2D", "DownEncoderBlock2D"], up_block_types = ["UpDecoderBlock2D", "UpDecoderBlock2D"]
+    ),
+    text_encoder = CLIPTextModel(text_config),
+    text_encoder_2 = CLIPTextModelWithProjection(text_config),
+    tokenizer = tokenizer,
+    tokenizer_2 = tokenizer,
+    scheduler = EulerDiscreteScheduler(beta_start = 0.00085, beta_end = 0.012, beta_schedule = "scaled_linear", steps_offset = 1, timestep_spacing = "leading")
+  )
+  pipeline.save_pretrained(path / "model")
+  return str(path / "model")
+
+
+@pytest.fixture(scope = "session")
+def tiny_unet_b(tmp_path_factory):
+  """
+  A checkpoint holding only a second UNet for `tiny_sdxl`, with other random weights
+  """
+  torch = pytest.importorskip("torch")
+  path = tmp_path_factory.mktemp("tiny-unet-b")
+  torch.manual_seed(1)
+  tiny_unet().save_pretrained(path / "unet")
+  return str(path)
+
+
+@pytest.fixture(scope = "session")
+def embeddings(tiny_sdxl):
+  """
+  Prompt embeddings of `tiny_sdxl` for "a cat", to pass to `generate`
+  """
+  torch = pytest.importorskip("torch")
+  from diffusers import StableDiffusionXLPipeline
+  from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+  pipeline = StableDiffusionXLPipeline.from_pretrained(tiny_sdxl, torch_dtype = sys.modules[Pipeline.__module__].default["inference"]["torch_dtype"])
+  with torch.no_grad():
+    prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = pipeline.encode_prompt(
+      "a cat", device = Pipeline.device, num_images_per_prompt = 1, do_classifier_free_guidance = True
+    )
+  return {
+    "prompt_embeds" : prompt_embeds,
+    "negative_prompt_embeds" : negative_prompt_embeds,
+    "pooled_prompt_embeds" : pooled_prompt_embeds,
+    "negative_pooled_prompt_embeds" : negative_pooled_prompt_embeds
+  }
@@ -0,0 +1,42 @@
+from os.path import join
+from shutil import copytree
+
+import pytest
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+
+torch = pytest.importorskip("torch")
+
+
+def write_unet(path, **changes):
+  from safetensors.torch import load_file, save_file
+  file_path = join(path, "unet", "diffusion_pytorch_model.safetensors")
+  save_file({**load_file(file_path), **changes}, file_path)
+
+
+def test_stale_rows_are_refreshed(tmp_path, tiny_sdxl, tiny_unet_b):
+  path = str(tmp_path / "model")
+  copytree(tiny_unet_b, path)
+  write_unet(path, **{"conv_in.bias" : torch.zeros(7)})
+  assert Pipeline.scan_catalog(str(tmp_path))["indexed"] == 2
+  assert Pipeline.check_compatibility(tiny_sdxl, path) is None
+  assert Pipeline.check_compatibility(path, path)["mismatched"] == {}
+  Pipeline.scan_catalog(tiny_sdxl)
+  assert "conv_in.bias" in Pipeline.check_compatibility(tiny_sdxl, path)["mismatched"]
+  # fixed on disk without scanning again
+  copytree(tiny_unet_b, path, dirs_exist_ok = True)
+  assert Pipeline.check_compatibility(tiny_sdxl, path)["mismatched"] == {}
+  Pipeline.merge(tiny_sdxl, path)
+
+
+def test_new_and_removed_variants_are_picked_up(tmp_path, tiny_unet_b):
+  from os import remove
+  from shutil import copyfile
+  path = str(tmp_path / "model")
+  copytree(tiny_unet_b, path)
+  Pipeline.scan_catalog(path)
+  assert Pipeline.catalog_variants(path) == [""]
+  copyfile(join(path, "unet", "diffusion_pytorch_model.safetensors"), join(path, "unet", "diffusion_pytorch_model.bf16-00001-of-00001.safetensors"))
+  assert Pipeline.catalog_variants(path) == ["", "bf16"]
+  remove(join(path, "unet", "diffusion_pytorch_model.safetensors"))
+  assert Pipeline.catalog_variants(path) == ["bf16"]
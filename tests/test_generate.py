@@ -0,0 +1,48 @@
+import numpy
+import pytest
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+
+torch = pytest.importorskip("torch")
+
+options = {"num_inference_steps" : 2, "height" : 64, "width" : 64, "output_type" : "np"}
+
+
+@pytest.fixture(autouse = True)
+def model(tiny_sdxl):
+  Pipeline.load_model(tiny_sdxl, skip_load_from_memory = True)
+
+
+def singles(embeddings, seeds):
+  return numpy.stack([Pipeline.generate(seed = seed, **embeddings, **options)[0] for seed in seeds])
+
+
+def test_seeds_give_the_same_images_as_single_runs(embeddings):
+  images, stats = Pipeline.generate(seeds = [1, 2, 3], return_stats = True, **embeddings, **options)
+  assert stats["seeds"] == [1, 2, 3]
+  assert (images == singles(embeddings, [1, 2, 3])).all()
+  assert not (images[0] == images[1]).all()
+
+
+def test_seed_counts_up_per_image(embeddings):
+  images = Pipeline.generate(seed = 5, num_images_per_prompt = 2, **embeddings, **options)
+  assert (images == singles(embeddings, [5, 6])).all()
+
+
+def test_batches_stay_within_the_documented_tolerance(embeddings):
+  images = Pipeline.generate(seeds = [1, 2, 3], batch_size = None, **embeddings, **options)
+  assert numpy.abs(images - singles(embeddings, [1, 2, 3])).max() <= 4 / 255
+
+
+def test_vae_tiling_decodes_in_tiles(embeddings, monkeypatch):
+  from diffusers import AutoencoderKL
+  tiled_decode = AutoencoderKL.tiled_decode
+  calls = []
+  def spy(self, *args, **kwargs):
+    calls.append((self.tile_sample_min_size, self.tile_latent_min_size))
+    return tiled_decode(self, *args, **kwargs)
+  monkeypatch.setattr(AutoencoderKL, "tiled_decode", spy)
+  Pipeline.generate(seed = 1, profile = {"vae_tiling" : 32}, **embeddings, **options)
+  assert calls == [(32, 16)]
+  vae = Pipeline.current[2].vae
+  assert not vae.use_tiling and vae.tile_sample_min_size == vae.config.sample_size
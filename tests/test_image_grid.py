@@ -0,0 +1,28 @@
+import numpy
+import pytest
+from PIL import Image
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+
+
+def images(count):
+  random = numpy.random.default_rng(0)
+  return [Image.fromarray(random.integers(0, 256, (32, 48, 3), dtype = "uint8")) for _ in range(count)]
+
+
+def test_grid_in_memory_matches_png(tmp_path):
+  grid = Pipeline.image_grid(images(4), rows = 2, cols = 2, prompt = "a cat " * 20, font_size = 8)
+  output = Pipeline.image_grid(iter(images(4)), rows = 2, cols = 2, prompt = "a cat " * 20, font_size = 8, output = str(tmp_path / "grid.png"))
+  assert grid.size == (96, 64)
+  assert (numpy.asarray(Image.open(output)) == numpy.asarray(grid)).all()
+  assert (numpy.asarray(grid)[32:, 48:] == numpy.asarray(images(4)[3])).all()
+
+
+@pytest.mark.parametrize("count", [3, 5])
+def test_wrong_image_count_leaves_no_file(tmp_path, count):
+  output = tmp_path / "grid.png"
+  with pytest.raises(AssertionError):
+    Pipeline.image_grid(images(count), rows = 2, cols = 2, output = str(output))
+  with pytest.raises(AssertionError):
+    Pipeline.image_grid(iter(images(count)), rows = 2, cols = 2, output = str(output))
+  assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,56 @@
+import pytest
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline, LazyComponent
+
+torch = pytest.importorskip("torch")
+
+options = {"num_inference_steps" : 2, "height" : 64, "width" : 64, "output_type" : "np"}
+components = ["text_encoder", "text_encoder_2", "unet", "vae"]
+
+
+@pytest.fixture(autouse = True)
+def model(tiny_sdxl):
+  Pipeline.load_model(tiny_sdxl, lazy = True, skip_load_from_memory = True)
+
+
+def loaded(*args, **kwargs):
+  return sorted(name for name, component in Pipeline.residency(*args, **kwargs).items() if component["loaded"])
+
+
+def test_components_are_loaded_on_first_use_and_released(tiny_sdxl, embeddings):
+  assert all(component["lazy"] for component in Pipeline.residency().values())
+  assert loaded() == []
+  images = Pipeline.generate(seed = 1, **embeddings, **options)
+  assert loaded() == ["unet", "vae"]
+  assert Pipeline.release(components = ["vae"]) == ["vae"]
+  assert loaded() == ["unet"]
+  assert sorted(Pipeline.release()) == ["unet"]
+  assert loaded() == []
+  assert (Pipeline.generate(seed = 1, **embeddings, **options) == images).all()
+
+
+def test_compose_on_a_lazy_model(tiny_sdxl, tiny_unet_b, embeddings):
+  Pipeline.compose(tiny_sdxl, name = "lazy base")
+  assert all(isinstance(getattr(Pipeline.current[2], name), LazyComponent) for name in components)
+  Pipeline.compose(tiny_sdxl, name = "lazy base, unet b", unet = tiny_unet_b)
+  assert loaded(name = "lazy base, unet b") == []
+  images = Pipeline.generate(seed = 1, **embeddings, **options)
+  Pipeline.load_model(tiny_sdxl)
+  assert not (Pipeline.generate(seed = 1, **embeddings, **options) == images).all()
+
+
+def test_alpha_sweep_on_a_lazy_model(tiny_sdxl, tiny_unet_b, embeddings):
+  expected = [Pipeline.generate(seed = 1, **embeddings, **options)[0]]
+  Pipeline.compose(tiny_sdxl, name = "unet b", lazy = True, unet = tiny_unet_b)
+  expected.append(Pipeline.generate(seed = 1, **embeddings, **options)[0])
+  for _ in range(2):
+    Pipeline.load_model(tiny_sdxl)
+    images = Pipeline.alpha_sweep(tiny_sdxl, tiny_unet_b, [0.0, 1.0], seed = 1, **embeddings, **options)
+    assert all((image == reference).all() for image, reference in zip(images, expected))
+
+
+def test_low_memory_profile_releases_every_stage(embeddings):
+  images, stats = Pipeline.generate(seed = 1, profile = "low_memory", return_stats = True, **embeddings, **options)
+  assert loaded() == []
+  assert {"unet", "vae"} <= set(stats)
+  assert images.shape == (1, 64, 64, 3)
@@ -0,0 +1,26 @@
+import pytest
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+
+torch = pytest.importorskip("torch")
+
+
+def state_dict(model):
+  return {key : tensor.clone() for key, tensor in model.state_dict().items()}
+
+
+def test_merge_sweep_matches_merge(tiny_sdxl, tiny_unet_b):
+  alphas = [0.0, 0.3, 1.0]
+  merged = {alpha : state_dict(Pipeline.merge(tiny_sdxl, tiny_unet_b, alpha = alpha)) for alpha in alphas}
+  for alpha, model in Pipeline.merge_sweep(tiny_sdxl, tiny_unet_b, alphas):
+    for key, tensor in model.state_dict().items():
+      assert torch.equal(tensor, merged[alpha][key]), (alpha, key)
+
+
+def test_merge_sweep_ends_on_both_models(tiny_sdxl, tiny_unet_b):
+  from diffusers import UNet2DConditionModel
+  ends = {alpha : state_dict(model) for alpha, model in Pipeline.merge_sweep(tiny_sdxl, tiny_unet_b, [0.0, 1.0])}
+  for alpha, path in ((0.0, tiny_sdxl), (1.0, tiny_unet_b)):
+    expected = UNet2DConditionModel.from_pretrained(path, subfolder = "unet").to(ends[alpha]["conv_in.weight"].dtype).state_dict()
+    for key, tensor in expected.items():
+      assert torch.equal(ends[alpha][key], tensor), (alpha, key)
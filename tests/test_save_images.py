@@ -0,0 +1,31 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from stablediffusers import ComposableStableDiffusionXLPipeline as Pipeline
+
+
+def images():
+  return numpy.random.default_rng(0).random((3, 16, 24, 3), dtype = "float32")
+
+
+def decode(result):
+  return numpy.asarray(Image.open(BytesIO(result["data"])))
+
+
+def test_save_images_on_threads():
+  results = sorted(Pipeline.save_images(images(), output = None), key = lambda result: result["index"])
+  assert [result["index"] for result in results] == [0, 1, 2]
+  for result, image in zip(results, images()):
+    assert (decode(result) == (image * 255).round().astype("uint8")).all()
+
+
+def test_save_images_on_processes(tmp_path):
+  output = str(tmp_path / "image_{index}.{format}")
+  with ProcessPoolExecutor(max_workers = 2) as executor:
+    results = sorted(Pipeline.save_images(images(), output = output, executor = executor), key = lambda result: result["index"])
+  assert [result["path"] for result in results] == [output.format(index = index, format = "png") for index in range(3)]
+  for result, image in zip(results, images()):
+    assert (numpy.asarray(Image.open(result["path"])) == (image * 255).round().astype("uint8")).all()